@@ -13,23 +13,156 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from os.path import join, dirname, exists
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BufferedReader
+from mmap import mmap, ACCESS_READ
+from os import fstat, makedirs, stat
+from os.path import join, dirname, exists, getmtime, isabs, normpath
+from os.path import pardir, sep, splitdrive, splitext
 from shutil import rmtree
-from json import load
+from sys import version_info
+from threading import Lock, local
+from weakref import WeakSet
 from zipfile import ZipFile
 from appdirs import user_data_dir
 from ._native import ffi, lib
 
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+try:
+    from mmap import MADV_RANDOM
+except ImportError:
+    MADV_RANDOM = None
 
-class _RaiseRust(object):
-    def __enter__(self):
-        pass
+_parsed_json = {}
+_pack_paths = {}
+_MAX_OPEN_PACKS = 32
+_COPY_BUFFER_SIZE = 1 << 20
+_copy_buffers = local()
+_open_caches = WeakSet()
 
-    def __exit__(self, exc_type, exc_val, exe_tb):
-        maybe_err = ffi.gc(lib.err_get_last_message(),
-                           lib.err_last_message_free)
-        if maybe_err:
-            raise Exception(ffi.string(maybe_err))
+
+@atexit.register
+def _close_caches():
+    for cache in list(_open_caches):
+        cache.close()
+
+
+def _load_json(path):
+    """Load a JSON file written by the Rust layer.
+
+    The parsed result is memoized for the life of the process, and the same
+    object is returned to every caller. The memo is keyed on the size and
+    modification time of the JSON file, so it is discarded as soon as the
+    Rust layer rewrites it.
+    """
+    st = stat(path)
+    stamp = (getattr(st, "st_mtime_ns", st.st_mtime), st.st_size)
+    cached = _parsed_json.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    with open(path, "rb") as i:
+        parsed = _json.loads(i.read())
+    _parsed_json[path] = (stamp, parsed)
+    return parsed
+
+
+def _cached_pack_path(data_path, vendor, pack, version):
+    """Memoized path of a cached PACK; there are only as many keys as PACKs."""
+    key = (data_path, vendor, pack, version)
+    try:
+        return _pack_paths[key]
+    except KeyError:
+        path = _pack_paths[key] = join(data_path, vendor, pack,
+                                       version + ".pack")
+        return path
+
+
+def _open_member(pack, name):
+    """Open a member of a PACK file named by the index.
+
+    Indexes written by older releases kept the '\\' separators found in some
+    PDSC files, so retry with '/' when the name is not found.
+    """
+    try:
+        return pack.open(name)
+    except KeyError:
+        return pack.open(name.replace(u'\\', '/'))
+
+
+def _join_within(root, *parts):
+    """Join parts onto root, refusing any result that escapes root.
+
+    The parts come from PDSC files, which are supplied by vendors, so they
+    must not be trusted to stay within the directory they are written to.
+    """
+    path = normpath(join(*parts))
+    if (isabs(path) or splitdrive(path)[0] or path == pardir or
+            path.startswith(pardir + sep)):
+        raise ValueError("Refusing to write {!r} outside of {!r}"
+                         .format(join(*parts), root))
+    return join(root, path)
+
+
+def _copy_file(src, dst):
+    """Copy one file object into another through a per-thread buffer.
+
+    The buffer is allocated once per thread and reused for every copy.
+    """
+    buf = getattr(_copy_buffers, "buf", None)
+    if buf is None:
+        buf = _copy_buffers.buf = bytearray(_COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    while True:
+        size = src.readinto(buf)
+        if not size:
+            break
+        dst.write(view[:size])
+
+
+class _MappedPack(mmap):
+    """A read-only memory map of a PACK file that ZipFile can read from."""
+    def seekable(self):
+        return True
+
+
+def _map_pack(path):
+    """Memory map a PACK file for random access to its members.
+
+    Python 2's ZipFile reads every member of a file object it was handed from
+    that object's current position, so there the path is returned as is and
+    ZipFile opens a file of its own for each member. So it is for empty
+    files, which cannot be mapped, leaving ZipFile to reject them.
+    """
+    if version_info[0] < 3:
+        return path
+    with open(path, "rb") as fd:
+        if not fstat(fd.fileno()).st_size:
+            return path
+        mapped = _MappedPack(fd.fileno(), 0, access=ACCESS_READ)
+    if MADV_RANDOM is not None:
+        mapped.madvise(MADV_RANDOM)
+    return mapped
+
+
+def _to_cstring(value):
+    """Convert an optional path into a C string for the Rust layer."""
+    if not value:
+        return ffi.NULL
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return ffi.new("char[]", value)
+
+
+def _check_rust_err():
+    """Raise the error left behind by the last call into Rust, if any."""
+    maybe_err = ffi.gc(lib.err_get_last_message(), lib.err_last_message_free)
+    if maybe_err:
+        raise Exception(ffi.string(maybe_err))
 
 
 class Cache (object):
@@ -48,13 +181,17 @@ class Cache (object):
     """
     def __init__(self, _, __, json_path=None, data_path=None, vidx_list=None):
         default_path = user_data_dir('cmsis-pack-manager')
-        json_path = default_path if not json_path else json_path
+        json_path = json_path or default_path
         self._index = {}
         self._aliases = {}
         self.index_path = join(json_path, "index.json")
         self.aliases_path = join(json_path, "aliases.json")
-        self.data_path = default_path if not data_path else data_path
+        self.data_path = data_path or default_path
         self.vidx_list = vidx_list
+        self._cstrings = {}
+        self._zip_cache = OrderedDict()
+        self._zip_cache_lock = Lock()
+        _open_caches.add(self)
 
     def get_flash_algorithm_binary(self, device_name, all=False):
         """Retrieve the flash algorithm file for a particular part.
@@ -72,16 +209,123 @@ class Cache (object):
                  True then an iterator for file-like objects is returned
         :rtype: ZipExtFile or ZipExtFile iterator if all is True
         """
-        device = self.index[device_name]
-        pack = self.pack_from_cache(device)
-        algo_itr = (pack.open(algo['file_name'].replace(u'\\', '/')) for algo
-                    in device['algorithms'])
-        return algo_itr if all else algo_itr.next()
+        if not all:
+            return self._open_algorithm(device_name)
+        device = self._device_entry(device_name)
+        return (_open_member(self._cached_pack(device), algo['file_name'])
+                for algo in device['algorithms'])
+
+    def extract_flash_algorithms(self, device_names, out_dir, max_workers=8):
+        """Extract the flash algorithms of many parts into a directory.
+
+        Assumes that both the PDSC and the PACK file associated with each part
+        are in the cache. Algorithms are extracted concurrently, and each is
+        written to `out_dir`/vendor/pack/version at the path it has within its
+        PACK file, so that algorithms from different PACKs never collide.
+
+        :raises ValueError: When an algorithm path would escape the directory
+                            of its PACK; nothing is extracted in that case
+
+        :param device_names: The exact names of the devices
+        :param out_dir: The directory to extract the algorithms into
+        :param max_workers: The number of algorithms to extract at once
+        :type device_names: list of str
+        :type out_dir: str
+        :type max_workers: int
+        :return: The paths of the extracted algorithms
+        :rtype: list of str
+        """
+        to_extract = {}
+        for device_name in device_names:
+            device = self._device_entry(device_name)
+            from_pack = device['from_pack']
+            pack_dir = _join_within(out_dir, from_pack['vendor'],
+                                    from_pack['pack'], from_pack['version'])
+            for algo in device['algorithms']:
+                # Indexes from older releases may still hold '\\' separators
+                member = algo['file_name'].replace(u'\\', '/')
+                to_extract[_join_within(pack_dir, member)] = (device, member)
+        for dest in to_extract:
+            if not exists(dirname(dest)):
+                makedirs(dirname(dest))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._extract_member, device, member,
+                                       dest)
+                       for dest, (device, member) in to_extract.items()]
+            for future in futures:
+                future.result()
+        return list(to_extract)
+
+    def open_flash_algorithm(self, device_name):
+        """Open the flash algorithm file of a particular part for reading.
+
+        Like `get_flash_algorithm_binary`, but the returned file reads from
+        the PACK file in large chunks.
+
+        :param device_name: The exact name of a device
+        :type device_name: str
+        :return: A file-like object that, when read, is the ELF file that
+                 describes the flashing algorithm
+        :rtype: BufferedReader
+        """
+        return BufferedReader(self._open_algorithm(device_name),
+                              buffer_size=_COPY_BUFFER_SIZE)
+
+    def write_flash_algorithm(self, device_name, dest):
+        """Write the flash algorithm file of a particular part to disk.
+
+        :param device_name: The exact name of a device
+        :param dest: The path to write the flash algorithm to
+        :type device_name: str
+        :type dest: str
+        """
+        with self._open_algorithm(device_name) as src:
+            with open(dest, "wb") as dst:
+                _copy_file(src, dst)
+
+    def _open_algorithm(self, device_name):
+        device = self._device_entry(device_name)
+        algo = device['algorithms'][0]
+        return _open_member(self._cached_pack(device), algo['file_name'])
+
+    def _extract_member(self, device, member, dest):
+        with self._cached_pack(device).open(member) as src:
+            with open(dest, "wb") as dst:
+                _copy_file(src, dst)
+
+    def _device_entry(self, device_name):
+        """Retrieve a single device from the index without parsing all of it.
+
+        Uses the table of offsets written alongside the index to read only
+        the part of the index that describes the device. Falls back to the
+        full index when that table is missing or older than the index.
+        """
+        if self._index:
+            return self._index[device_name]
+        try:
+            if getmtime(self.offsets_path) < getmtime(self.index_path):
+                return self.index[device_name]
+            offsets = _load_json(self.offsets_path)
+        except (IOError, OSError):
+            return self.index[device_name]
+        offset, length = offsets[device_name]
+        with open(self.index_path, "rb") as i:
+            i.seek(offset)
+            return _json.loads(i.read(length))
+
+    @property
+    def offsets_path(self):
+        """The table of offsets written alongside `index_path`."""
+        return splitext(self.index_path)[0] + ".offsets.json"
 
     @property
     def index(self):
         """An index of most of the important data in all cached PDSC files.
 
+        The parsed index is shared by every Cache in the process that reads
+        the same file, so it should be treated as read-only; copy it before
+        modifying it.
+
         :Example:
 
         >>> from ArmPackManager import Cache
@@ -116,14 +360,16 @@ class Cache (object):
 
         """
         if not self._index:
-            with open(self.index_path) as i:
-                self._index = load(i)
+            self._index = _load_json(self.index_path)
         return self._index
 
     @property
     def aliases(self):
         """An index of the boards in all CMSIS Pack Descriptions.
 
+        Like `index`, the parsed aliases are shared by every Cache in the
+        process that reads the same file, and should be treated as read-only.
+
         :Example:
 
         >>> from cmsis_pack_manager import Cache
@@ -134,10 +380,32 @@ class Cache (object):
         """
 
         if not self._aliases:
-            with open(self.aliases_path) as i:
-                self._aliases = load(i)
+            self._aliases = _load_json(self.aliases_path)
         return self._aliases
 
+    def iter_devices(self):
+        """Iterate over the devices in the index without loading all of it.
+
+        Only one device is held in memory at a time, which makes this
+        preferable to `index` when every device is visited once.
+
+        :return: An iterator of (device name, device) pairs
+        """
+        import ijson
+        with open(self.index_path, "rb") as i:
+            for item in ijson.kvitems(i, ''):
+                yield item
+
+    def iter_aliases(self):
+        """Iterate over the boards in the aliases without loading all of them.
+
+        :return: An iterator of (board name, board) pairs
+        """
+        import ijson
+        with open(self.aliases_path, "rb") as i:
+            for item in ijson.kvitems(i, ''):
+                yield item
+
     def cache_everything(self):
         """Cache every CMSIS Pack and generate an index.
 
@@ -145,44 +413,43 @@ class Cache (object):
         2 minutes to complete.
         """
         parsed_packs = self.cache_descriptors()
-        if self.data_path:
-            cdata_path = ffi.new("char[]", self.data_path.encode("utf-8"))
-        else:
-            cdata_path = ffi.NULL
-        lib.update_packs(cdata_path, parsed_packs)
+        lib.update_packs(self._cstring(self.data_path), parsed_packs)
+        _check_rust_err()
 
     def _call_rust_update(self):
-        if self.data_path:
-            cdata_path = ffi.new("char[]", self.data_path.encode("utf-8"))
-        else:
-            cdata_path = ffi.NULL
-        if self.vidx_list:
-            cvidx_path = ffi.new("char[]", self.vidx_list.encode("utf-8"))
-        else:
-            cvidx_path = ffi.NULL
-        with _RaiseRust():
-            pdsc_index = ffi.gc(lib.update_pdsc_index(cdata_path, cvidx_path),
-                                lib.update_pdsc_index_free)
+        cdata_path = self._cstring(self.data_path)
+        cvidx_path = self._cstring(self.vidx_list)
+        pdsc_index = ffi.gc(lib.update_pdsc_index(cdata_path, cvidx_path),
+                            lib.update_pdsc_index_free)
+        _check_rust_err()
         return pdsc_index
 
     def _call_rust_parse(self, pdsc_index):
-        if self.index_path:
-            cindex_path = ffi.new("char[]", self.index_path.encode("utf-8"))
-        else:
-            cindex_path = ffi.NULL
-        if self.aliases_path:
-            calias_path = ffi.new("char[]", self.aliases_path.encode("utf-8"))
-        else:
-            calias_path = ffi.NULL
-        with _RaiseRust():
-            parsed_packs = ffi.gc(lib.parse_packs(pdsc_index),
-                                  lib.parse_packs_free)
-        with _RaiseRust():
-            pdsc_index = lib.dump_pdsc_json(
-                parsed_packs, cindex_path, calias_path
-            )
+        parsed_packs = ffi.gc(lib.parse_packs(pdsc_index),
+                              lib.parse_packs_free)
+        _check_rust_err()
+        lib.dump_pdsc_json(parsed_packs, self._cstring(self.index_path),
+                           self._cstring(self.aliases_path))
+        _check_rust_err()
+        # The rewritten files may keep their size and modification time
+        for path in (self.index_path, self.offsets_path, self.aliases_path):
+            _parsed_json.pop(path, None)
+        self._index = {}
+        self._aliases = {}
         return parsed_packs
 
+    def _cstring(self, value):
+        """Convert one of this Cache's paths into a C string.
+
+        Each C string is built once for every value the path takes, so that
+        reassigning a path is seen by the next call into Rust.
+        """
+        try:
+            return self._cstrings[value]
+        except KeyError:
+            cvalue = self._cstrings[value] = _to_cstring(value)
+            return cvalue
+
     def cache_descriptors(self):
         """Cache all Pack Descriptions and generate an index of them.
 
@@ -195,11 +462,11 @@ class Cache (object):
 
     def cache_clean(self):
         """Clean the entire cache."""
-        if exists(self.data_path):
-            rmtree(self.data_path)
-        json_path = dirname(self.index_path)
-        if exists(json_path):
-            rmtree(json_path)
+        self.close()
+        to_remove = set([self.data_path, dirname(self.index_path)])
+        with ThreadPoolExecutor(max_workers=len(to_remove)) as executor:
+            for path in to_remove:
+                executor.submit(rmtree, path, ignore_errors=True)
 
     def pdsc_from_cache(self, device):
         """Low level inteface for extracting a PDSC file from the cache.
@@ -226,11 +493,35 @@ class Cache (object):
         :return: A parsed representation of the PACK file.
         :rtype: ZipFile
         """
+        return ZipFile(_map_pack(self._pack_file_path(device)))
+
+    def _pack_file_path(self, device):
         from_pack = device['from_pack']
-        return ZipFile(join(self.data_path,
-                            from_pack['vendor'],
-                            from_pack['pack'],
-                            from_pack['version'] + ".pack"))
+        return _cached_pack_path(self.data_path, from_pack['vendor'],
+                                 from_pack['pack'], from_pack['version'])
+
+    def _cached_pack(self, device):
+        """Like `pack_from_cache`, but reuses recently opened PACK files.
+
+        The returned ZipFile is shared, so it must not be closed. A PACK that
+        falls out of the cache is not closed either; it is closed once the
+        last reference to it, or to a member opened from it, goes away.
+        """
+        path = self._pack_file_path(device)
+        with self._zip_cache_lock:
+            pack = self._zip_cache.pop(path, None)
+            if pack is None or pack.fp is None:
+                pack = ZipFile(_map_pack(path))
+                if len(self._zip_cache) >= _MAX_OPEN_PACKS:
+                    self._zip_cache.popitem(last=False)
+            self._zip_cache[path] = pack
+        return pack
+
+    def close(self):
+        """Close all PACK files held open by this Cache."""
+        with self._zip_cache_lock:
+            while self._zip_cache:
+                self._zip_cache.popitem()[1].close()
 
     @staticmethod
     def find_pdsc(zipfile):
@@ -241,17 +532,25 @@ class Cache (object):
         :return: The location of the PDSC file within the PACK file
         :rtype: str
         """
-        for zipinfo in zipfile.infolist():
-            if (zipinfo.filename.upper().endswith(".PDSC")):
-                return zipinfo.filename
-        return None
+        return next((name for name in zipfile.namelist()
+                     if name[-5:].upper() == ".PDSC"), None)
 
     def add_pack_from_path(self, path):
-        if path:
-            cpack_path = ffi.new("char[]", path.encode("utf-8"))
-        else:
-            cpack_path = ffi.NULL
-        with _RaiseRust():
-            pack_files = ffi.gc(lib.pack_from_path(cpack_path),
-                                lib.update_pdsc_index_free)
+        cpack_path = _to_cstring(path)
+        pack_files = ffi.gc(lib.pack_from_path(cpack_path),
+                            lib.update_pdsc_index_free)
+        _check_rust_err()
+        return self._call_rust_parse(pack_files)
+
+    def add_packs_from_paths(self, paths):
+        """Add many PDSC files to the index with a single call into Rust.
+
+        :param paths: The paths of the PDSC files to add
+        :type paths: list of str
+        """
+        cpack_paths = [_to_cstring(path) for path in paths]
+        cpack_array = ffi.new("char*[]", cpack_paths)
+        pack_files = ffi.gc(lib.pack_from_paths(cpack_array, len(cpack_paths)),
+                            lib.update_pdsc_index_free)
+        _check_rust_err()
         return self._call_rust_parse(pack_files)
@@ -165,9 +165,9 @@ def command_find_part(cache, matches, long=False, intersection=True,
             help='Create a directory with an `index.json` describing the part '
             'and all of the associated flashing algorithms.')
 def command_dump_parts(cache, out, parts, intersection=False):
-    op = operator.and_ if intersection else operator.or_
-    index = {part: cache.index[part] for part
-             in fuzzy_find(parts, cache.index, op)}
+    op = all if intersection else any
+    index = {name: device for name, device in cache.iter_devices()
+             if op(part in name for part in parts)}
     if not exists(out):
         makedirs(out)
     for n, p in index.items():
@@ -191,8 +191,7 @@ def command_dump_parts(cache, out, parts, intersection=False):
                  help='path to pdsc to add into the index'),
             help='add contents of pdsc files into the index')
 def command_add_packs(cache, path, intersection=False):
-    for p in path:
-        cache.add_pack_from_path(p)
+    cache.add_packs_from_paths(path)
 
 
 def get_argparse():
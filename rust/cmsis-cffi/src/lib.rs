@@ -4,6 +4,7 @@ extern crate cmsis_update;
 extern crate failure;
 extern crate pack_index as pi;
 extern crate pdsc as pack_desc;
+extern crate rayon;
 extern crate slog_async;
 extern crate slog_term;
 extern crate utils as cmsis_utils;
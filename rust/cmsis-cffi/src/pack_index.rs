@@ -5,6 +5,7 @@ use std::path::PathBuf;
 use std::ptr::null_mut;
 
 use failure::err_msg;
+use rayon::prelude::*;
 
 use cmsis_update::update;
 use pi::config::ConfigBuilder;
@@ -19,6 +20,10 @@ impl UpdateReturn {
     pub fn iter(&self) -> impl Iterator<Item = &PathBuf> {
         self.0.iter()
     }
+
+    pub fn par_iter(&self) -> impl ParallelIterator<Item = &PathBuf> {
+        self.0.par_iter()
+    }
 }
 
 cffi!{
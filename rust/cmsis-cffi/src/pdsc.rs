@@ -5,8 +5,10 @@ use std::borrow::Cow;
 use std::ffi::{CStr, CString};
 use std::os::raw::c_char;
 use std::path::{Path, PathBuf};
+use std::slice;
 
 use failure::err_msg;
+use rayon::prelude::*;
 
 use cmsis_utils::parse::FromElem;
 use cmsis_utils::ResultLogExt;
@@ -70,6 +72,30 @@ cffi!{
     }
 }
 
+cffi!{
+    fn pack_from_paths(ptrs: *const *const c_char, len: usize) -> Result<*mut UpdateReturn>{
+        if !ptrs.is_null() {
+            let ptrs = unsafe { slice::from_raw_parts(ptrs, len) };
+            let mut paths = Vec::with_capacity(len);
+            for &ptr in ptrs {
+                if ptr.is_null() {
+                    return Err(err_msg("Null passed into pack_from_paths"));
+                }
+                let fname = unsafe { CStr::from_ptr(ptr) }.to_string_lossy();
+                let mut pathbuf = PathBuf::new();
+                pathbuf.push::<&str>(&fname);
+                if !pathbuf.exists() {
+                    return Err(err_msg(format!("Could not find file {:?}", &pathbuf)));
+                }
+                paths.push(pathbuf);
+            }
+            Ok(Box::into_raw(Box::new(UpdateReturn::from_vec(paths))))
+        } else {
+            Err(err_msg("Null passed into pack_from_paths"))
+        }
+    }
+}
+
 cffi!{
     fn parse_packs(ptr: *mut UpdateReturn) -> Result<*mut ParsedPacks>{
         if !ptr.is_null() {
@@ -78,7 +104,8 @@ cffi!{
                 let drain = FullFormat::new(decorator).build().fuse();
                 let drain = Async::new(drain).build().fuse();
                 let log = Logger::root(drain, o!());
-                let pdsc_files = boxed.iter();
+                // Each PDSC is parsed independently, so spread them over all cores
+                let pdsc_files = boxed.par_iter();
                 Ok(Box::into_raw(Box::new(ParsedPacks(
                     pdsc_files
                         .filter_map(|input| Package::from_path(Path::new(input), &log).ok_warn(&log))
@@ -1,5 +1,5 @@
 use std::fs::{create_dir_all, rename, OpenOptions};
-use std::io::Write;
+use std::io::{BufWriter, Write};
 use std::path::PathBuf;
 use std::sync::Mutex;
 
@@ -16,6 +16,8 @@ use pack_index::config::Config;
 
 use redirect::ClientRedirExt;
 
+const WRITE_BUFFER_SIZE: usize = 256 * 1024;
+
 pub(crate) trait IntoDownload {
     fn into_uri(&self, &Config) -> Result<Uri, Error>;
     fn into_fd(&self, &Config) -> PathBuf;
@@ -76,15 +78,20 @@ fn download_file<'b, C: Connect, P: DownloadProgress + 'b>(
     async_block!{
         let response = await!(client.redirectable(source, logger))?;
         let temp = dest.with_extension("part");
-        let mut fd = OpenOptions::new()
+        let fd = OpenOptions::new()
             .write(true)
             .create(true)
             .open(&temp)?;
+        // Response bodies arrive in small chunks; coalesce them into large
+        // writes so that a PACK costs few write syscalls.
+        let mut fd = BufWriter::with_capacity(WRITE_BUFFER_SIZE, fd);
         #[async]
         for bytes in response.body() {
             fd.write_all(bytes.as_ref())?;
             spinner.progress(bytes.len());
         }
+        fd.flush()?;
+        drop(fd);
         rename(&temp, &dest)?;
         spinner.complete();
         Ok(dest)
@@ -3,6 +3,7 @@ use std::path::PathBuf;
 use std::str::FromStr;
 
 use minidom::{Element, Error, ErrorKind};
+use serde::{Deserialize, Deserializer};
 use slog::Logger;
 
 use utils::parse::{attr_map, attr_parse, attr_parse_hex, FromElem};
@@ -364,7 +365,7 @@ impl FromElem for MemElem {
 }
 
 #[derive(Clone, Debug, Serialize, Deserialize)]
-pub struct Memories(HashMap<String, Memory>);
+pub struct Memories(BTreeMap<String, Memory>);
 
 fn merge_memories(lhs: Memories, rhs: &Memories) -> Memories {
     let rhs: Vec<_> = rhs
@@ -382,8 +383,21 @@ fn merge_memories(lhs: Memories, rhs: &Memories) -> Memories {
     lhs
 }
 
+/// PACK files are zip archives, which always separate paths with '/'
+fn forward_slashes(path: &str) -> PathBuf {
+    path.replace('\\', "/").into()
+}
+
+fn deserialize_forward_slashes<'de, D>(deserializer: D) -> Result<PathBuf, D::Error>
+where
+    D: Deserializer<'de>,
+{
+    String::deserialize(deserializer).map(|path| forward_slashes(&path))
+}
+
 #[derive(Debug, Clone, Serialize, Deserialize)]
 pub struct Algorithm {
+    #[serde(deserialize_with = "deserialize_forward_slashes")]
     file_name: PathBuf,
     start: u64,
     size: u64,
@@ -395,7 +409,7 @@ pub struct Algorithm {
 impl FromElem for Algorithm {
     fn from_elem(e: &Element, _l: &Logger) -> Result<Self, Error> {
         Ok(Self {
-            file_name: attr_map(e, "name", "algorithm")?,
+            file_name: forward_slashes(attr_map(e, "name", "algorithm")?),
             start: attr_parse_hex(e, "start", "algorithm")?,
             size: attr_parse_hex(e, "size", "algorithm")?,
             ram_start: attr_parse_hex(e, "RAMstart", "algorithm").ok(),
@@ -423,7 +437,7 @@ pub struct Device {
 
 impl<'dom> DeviceBuilder<'dom> {
     fn from_elem(e: &'dom Element) -> Self {
-        let memories = Memories(HashMap::new());
+        let memories = Memories(BTreeMap::new());
         DeviceBuilder {
             name: e.attr("Dname").or_else(|| e.attr("Dvariant")),
             memories,
@@ -5,6 +5,7 @@ extern crate slog;
 #[macro_use]
 extern crate serde_derive;
 extern crate failure;
+extern crate serde;
 extern crate serde_json;
 
 extern crate clap;
@@ -13,11 +14,12 @@ extern crate pack_index;
 
 use clap::{App, Arg, ArgMatches, SubCommand};
 use minidom::{Element, Error, ErrorKind};
+use serde::Serialize;
 use slog::Logger;
 use std::borrow::Cow;
 use std::collections::{BTreeMap, HashMap};
 use std::fs::OpenOptions;
-use std::io::Read;
+use std::io::{Read, Write};
 use std::path::Path;
 
 use failure::Error as FailError;
@@ -350,6 +352,34 @@ pub fn dump_devices_args<'a, 'b>() -> App<'a, 'b> {
         )
 }
 
+/// Serialize a map as a JSON object with one entry per line, recording the
+/// byte offset and length of every value so that a reader may parse a single
+/// entry without parsing the whole object.
+fn to_indexed_json<K, V>(
+    map: &BTreeMap<K, V>,
+) -> Result<(Vec<u8>, BTreeMap<&K, (usize, usize)>), FailError>
+where
+    K: Serialize + Ord,
+    V: Serialize,
+{
+    let mut contents = Vec::new();
+    let mut offsets = BTreeMap::new();
+    contents.push(b'{');
+    for (num, (key, value)) in map.iter().enumerate() {
+        if num != 0 {
+            contents.push(b',');
+        }
+        contents.extend_from_slice(b"\n  ");
+        serde_json::to_writer(&mut contents, key)?;
+        contents.extend_from_slice(b": ");
+        let start = contents.len();
+        serde_json::to_writer(&mut contents, value)?;
+        offsets.insert(key, (start, contents.len() - start));
+    }
+    contents.extend_from_slice(b"\n}\n");
+    Ok((contents, offsets))
+}
+
 pub fn dump_devices<'a, P: AsRef<Path>, I: IntoIterator<Item = &'a Package>>(
     pdscs: I,
     device_dest: Option<P>,
@@ -373,14 +403,24 @@ pub fn dump_devices<'a, P: AsRef<Path>, I: IntoIterator<Item = &'a Package>>(
                 let mut all_devices = BTreeMap::new();
                 all_devices.extend(old_devices.iter());
                 all_devices.extend(devices.iter());
-                let mut options = OpenOptions::new();
-                options.write(true);
-                options.create(true);
-                options.truncate(true);
-                if let Ok(fd) = options.open(to_file.as_ref()) {
-                    serde_json::to_writer_pretty(fd, &all_devices).unwrap();
-                } else {
-                    println!("Could not open file {:?}", to_file.as_ref());
+                let (contents, offsets) = to_indexed_json(&all_devices)?;
+                let offsets_file = to_file.as_ref().with_extension("offsets.json");
+                // Leave the index alone when nothing in it changed
+                if contents != file_contents || !offsets_file.exists() {
+                    let mut options = OpenOptions::new();
+                    options.write(true);
+                    options.create(true);
+                    options.truncate(true);
+                    if let Ok(mut fd) = options.open(to_file.as_ref()) {
+                        fd.write_all(&contents)?;
+                    } else {
+                        println!("Could not open file {:?}", to_file.as_ref());
+                    }
+                    if let Ok(fd) = options.open(&offsets_file) {
+                        serde_json::to_writer(fd, &offsets)?;
+                    } else {
+                        println!("Could not open file {:?}", &offsets_file);
+                    }
                 }
             }
         }
@@ -402,14 +442,17 @@ pub fn dump_devices<'a, P: AsRef<Path>, I: IntoIterator<Item = &'a Package>>(
             let mut all_boards = BTreeMap::new();
             all_boards.extend(old_boards.iter());
             all_boards.extend(boards.iter());
-            let mut options = OpenOptions::new();
-            options.write(true);
-            options.create(true);
-            options.truncate(true);
-            if let Ok(fd) = options.open(to_file.as_ref()) {
-                serde_json::to_writer_pretty(fd, &all_boards).unwrap();
-            } else {
-                println!("Could not open file {:?}", to_file.as_ref());
+            let contents = serde_json::to_vec_pretty(&all_boards)?;
+            if contents != file_contents {
+                let mut options = OpenOptions::new();
+                options.write(true);
+                options.create(true);
+                options.truncate(true);
+                if let Ok(mut fd) = options.open(to_file.as_ref()) {
+                    fd.write_all(&contents)?;
+                } else {
+                    println!("Could not open file {:?}", to_file.as_ref());
+                }
             }
         }
         None => println!("{}", &serde_json::to_string_pretty(&devices).unwrap()),
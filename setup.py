@@ -54,7 +54,10 @@ setup(
         'pytest-runner'],
     install_requires=[
         'appdirs>=1.4',
+        'futures>=3.0; python_version < "3.0"',
+        'ijson>=2.5',
         'milksnake>=0.1.2',
+        'orjson>=2.0; python_version >= "3.6"',
         'pyyaml>=3.12'],
     tests_require=[
         'hypothesis',
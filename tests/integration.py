@@ -84,6 +84,18 @@ def test_add_pack_from_path():
     c = cmsis_pack_manager.Cache(
         True, True, json_path=json_path, data_path=data_path)
     c.add_pack_from_path(join(dirname(__file__), 'test-pack-index', 'MyVendor.MyPack.pdsc'))
+    device = c._device_entry("MyDevice")
+    assert("MyDevice" in c.index)
+    assert(device == c.index["MyDevice"])
+    assert("MyBoard" in c.aliases)
+    assert("MyDevice" in c.aliases["MyBoard"]["mounted_devices"])
+
+def test_add_packs_from_paths():
+    json_path = tempfile.mkdtemp()
+    data_path = tempfile.mkdtemp()
+    c = cmsis_pack_manager.Cache(
+        True, True, json_path=json_path, data_path=data_path)
+    c.add_packs_from_paths([join(dirname(__file__), 'test-pack-index', 'MyVendor.MyPack.pdsc')])
     assert("MyDevice" in c.index)
     assert("MyBoard" in c.aliases)
     assert("MyDevice" in c.aliases["MyBoard"]["mounted_devices"])
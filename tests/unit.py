@@ -1,14 +1,24 @@
 """Unit tests for the cmsis_pack_manager module"""
 
-from os.path import join
+import gc
+import operator
+import weakref
+from io import BytesIO
+from json import dump, dumps
+from os import makedirs, remove, urandom, utime
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+from zipfile import ZipFile, BadZipfile
 from string import ascii_lowercase, ascii_letters, hexdigits
-from mock import patch, MagicMock, call
+from mock import patch, MagicMock, ANY, call
 from hypothesis import given, settings, example
 from hypothesis.strategies import booleans, text, lists, just, integers, tuples
 from hypothesis.strategies import dictionaries, fixed_dictionaries
 from jinja2 import Template
 
 import cmsis_pack_manager
+from cmsis_pack_manager import pack_manager
 
 @given(text(alphabet=ascii_lowercase + "/", min_size=1),
        text(alphabet=ascii_lowercase, min_size=1),
@@ -33,12 +43,339 @@ def test_pdsc_from_cache(data_path, vendor, pack, version):
        text(alphabet=ascii_lowercase, min_size=1))
 def test_pack_from_cache(data_path, vendor, pack, version):
     @patch("cmsis_pack_manager.ZipFile")
-    def inner_test(_zf):
+    @patch("cmsis_pack_manager._map_pack")
+    def inner_test(_map_pack, _zf):
         c = cmsis_pack_manager.Cache(True, True, data_path=data_path)
         device = {'from_pack': {'vendor': vendor , 'pack': pack,
                                 'version': version}}
         c.pack_from_cache(device)
-        assert(vendor in _zf.call_args[0][0])
-        assert(pack in _zf.call_args[0][0])
-        assert(version in _zf.call_args[0][0])
+        assert(vendor in _map_pack.call_args[0][0])
+        assert(pack in _map_pack.call_args[0][0])
+        assert(version in _map_pack.call_args[0][0])
+        _zf.assert_called_once_with(_map_pack.return_value)
     inner_test()
+
+@given(dictionaries(text(alphabet=ascii_letters, min_size=1),
+                    integers(min_value=0, max_value=2 ** 64 - 1)))
+def test_load_json_memoized(contents):
+    json_path = mkdtemp()
+    index_path = join(json_path, "index.json")
+    with open(index_path, "w") as fd:
+        dump(contents, fd)
+    parsed = cmsis_pack_manager._load_json(index_path)
+    assert(parsed == contents)
+    assert(cmsis_pack_manager._load_json(index_path) is parsed)
+    assert(not exists(index_path + ".pkl"))
+    rmtree(json_path)
+
+def write_indexed_json(index_path, offsets_path, contents):
+    """Write an index and its offsets the way the Rust layer does"""
+    data = b"{"
+    offsets = {}
+    for num, (name, device) in enumerate(sorted(contents.items())):
+        if num:
+            data += b","
+        data += b"\n  " + dumps(name).encode("utf-8") + b": "
+        value = dumps(device).encode("utf-8")
+        offsets[name] = (len(data), len(value))
+        data += value
+    data += b"\n}\n"
+    with open(index_path, "wb") as fd:
+        fd.write(data)
+    with open(offsets_path, "w") as fd:
+        dump(offsets, fd)
+
+@given(dictionaries(text(alphabet=ascii_letters, min_size=1),
+                    dictionaries(text(alphabet=ascii_letters),
+                                 lists(integers(min_value=0,
+                                                max_value=2 ** 32))),
+                    min_size=1))
+def test_device_entry(contents):
+    json_path = mkdtemp()
+    index_path = join(json_path, "index.json")
+    offsets_path = join(json_path, "index.offsets.json")
+    write_indexed_json(index_path, offsets_path, contents)
+    for name, device in contents.items():
+        c = cmsis_pack_manager.Cache(True, True, json_path=json_path)
+        assert(c._device_entry(name) == device)
+        assert(not c._index)
+    # The offsets follow the index when it is moved
+    c = cmsis_pack_manager.Cache(True, True,
+                                 json_path=join(json_path, "elsewhere"))
+    c.index_path = index_path
+    assert(c.offsets_path == offsets_path)
+    # A stale offsets table falls back to the full index
+    utime(offsets_path, (0, 0))
+    for name, device in contents.items():
+        c = cmsis_pack_manager.Cache(True, True, json_path=json_path)
+        assert(c._device_entry(name) == device)
+        assert(c._index == contents)
+    # So does a missing one
+    remove(offsets_path)
+    for name, device in contents.items():
+        c = cmsis_pack_manager.Cache(True, True, json_path=json_path)
+        assert(c._device_entry(name) == device)
+        assert(c._index == contents)
+    rmtree(json_path)
+
+def test_parse_drops_memoized_json():
+    json_path = mkdtemp()
+    index_path = join(json_path, "index.json")
+    offsets_path = join(json_path, "index.offsets.json")
+
+    def dump_pdsc_json(contents):
+        write_indexed_json(index_path, offsets_path, contents)
+        utime(index_path, (1, 1))
+        utime(offsets_path, (1, 1))
+
+    dump_pdsc_json({"A": [1], "B": [2]})
+    c = cmsis_pack_manager.Cache(True, True, json_path=json_path)
+    assert(c._device_entry("B") == [2])
+    with patch.object(cmsis_pack_manager, "lib") as lib, \
+            patch.object(cmsis_pack_manager, "ffi"), \
+            patch.object(cmsis_pack_manager, "_check_rust_err"):
+        # The offsets of "B" move, but the offsets file keeps its size
+        lib.dump_pdsc_json.side_effect = lambda *_: dump_pdsc_json(
+            {"A": [1, 2, 3], "B": [4]})
+        c._call_rust_parse(None)
+    assert(c._device_entry("B") == [4])
+    rmtree(json_path)
+
+def test_rust_paths_follow_attributes():
+    c = cmsis_pack_manager.Cache(True, True, json_path="before",
+                                 data_path="before")
+    c.index_path = join("after", "index.json")
+    c.aliases_path = join("after", "aliases.json")
+    c.data_path = "after"
+    with patch.object(cmsis_pack_manager, "lib") as lib, \
+            patch.object(cmsis_pack_manager, "ffi") as ffi, \
+            patch.object(cmsis_pack_manager, "_check_rust_err"):
+        ffi.new.side_effect = lambda _, value: value
+        c.cache_everything()
+    lib.update_pdsc_index.assert_called_once_with(b"after", ffi.NULL)
+    lib.dump_pdsc_json.assert_called_once_with(
+        ANY, join("after", "index.json").encode("utf-8"),
+        join("after", "aliases.json").encode("utf-8"))
+    lib.update_packs.assert_called_once_with(b"after", ANY)
+
+def write_pack(data_path, vendor, members):
+    """Write a PACK into the cache and return a device that uses it"""
+    makedirs(join(data_path, vendor, "pack"))
+    with ZipFile(join(data_path, vendor, "pack", "1.0.0.pack"), "w") as pack:
+        for name, contents in members:
+            pack.writestr(name, contents)
+    return {'from_pack': {'vendor': vendor, 'pack': "pack",
+                          'version': "1.0.0"},
+            'algorithms': [{'file_name': name} for name, _ in members]}
+
+def test_pack_from_cache_empty_pack():
+    data_path = mkdtemp()
+    device = write_pack(data_path, "vendor", [])
+    c = cmsis_pack_manager.Cache(True, True, data_path=data_path)
+    open(c._pack_file_path(device), "wb").close()
+    try:
+        c.pack_from_cache(device)
+    except BadZipfile:
+        pass
+    else:
+        assert False, "An empty PACK was opened"
+    rmtree(data_path)
+
+@given(text(alphabet=ascii_lowercase, min_size=1),
+       text(alphabet=ascii_lowercase, min_size=1),
+       text(alphabet=ascii_lowercase, min_size=1))
+def test_cached_pack_reuses_zipfile(vendor, pack, version):
+    @patch("cmsis_pack_manager.ZipFile")
+    @patch("cmsis_pack_manager._map_pack")
+    def inner_test(_map_pack, _zf):
+        c = cmsis_pack_manager.Cache(True, True, data_path="data")
+        device = {'from_pack': {'vendor': vendor , 'pack': pack,
+                                'version': version}}
+        assert(c._cached_pack(device) is c._cached_pack(device))
+        assert(_zf.call_count == 1)
+        assert(c.pack_from_cache(device) is _zf.return_value)
+        assert(_zf.call_count == 2)
+        c.close()
+        _zf.return_value.close.assert_called_once_with()
+    inner_test()
+
+def test_pack_from_cache_closed_by_caller():
+    data_path = mkdtemp()
+    device = write_pack(data_path, "vendor", [("Flash/a.FLM", b"a")])
+    c = cmsis_pack_manager.Cache(True, True, data_path=data_path)
+    with patch.object(c, "_device_entry", return_value=device):
+        for _ in range(2):
+            with c.pack_from_cache(device) as pack:
+                assert(pack.read("Flash/a.FLM") == b"a")
+            assert(c.get_flash_algorithm_binary("device").read() == b"a")
+    c.close()
+    rmtree(data_path)
+
+@patch("cmsis_pack_manager._MAX_OPEN_PACKS", 1)
+def test_all_flash_algorithms_after_eviction():
+    data_path = mkdtemp()
+    first = write_pack(data_path, "first", [("Flash/a.FLM", b"a"),
+                                            ("Flash/b.FLM", b"b")])
+    second = write_pack(data_path, "second", [("Flash/c.FLM", b"c")])
+    c = cmsis_pack_manager.Cache(True, True, data_path=data_path)
+    with patch.object(c, "_device_entry", side_effect=[first, second]):
+        algos = c.get_flash_algorithm_binary("first", all=True)
+        assert(next(algos).read() == b"a")
+        assert(c.get_flash_algorithm_binary("second").read() == b"c")
+        c.close()
+        assert([algo.read() for algo in algos] == [b"b"])
+    c.close()
+    rmtree(data_path)
+
+def test_cache_is_collected():
+    c = cmsis_pack_manager.Cache(True, True, data_path="data")
+    ref = weakref.ref(c)
+    del c
+    gc.collect()
+    assert(ref() is None)
+
+@given(lists(text(alphabet=ascii_lowercase, min_size=1), min_size=1,
+             unique=True))
+def test_extract_flash_algorithms(algos):
+    data_path = mkdtemp()
+    out_dir = mkdtemp()
+    vendors = ["first", "second", "third"]
+    devices = dict((vendor, write_pack(data_path, vendor,
+                                       [("Flash/" + algo + ".FLM",
+                                         vendor + algo)
+                                        for algo in algos]))
+                   for vendor in vendors)
+    c = cmsis_pack_manager.Cache(True, True, data_path=data_path)
+    with patch.object(c, "_device_entry", side_effect=devices.get):
+        written = c.extract_flash_algorithms(vendors, out_dir)
+    c.close()
+    assert(len(written) == len(vendors) * len(algos))
+    for vendor in vendors:
+        for algo in algos:
+            with open(join(out_dir, vendor, "pack", "1.0.0", "Flash",
+                           algo + ".FLM")) as fd:
+                assert(fd.read() == vendor + algo)
+    rmtree(data_path)
+    rmtree(out_dir)
+
+def test_extract_flash_algorithms_outside_out_dir():
+    data_path = mkdtemp()
+    root = mkdtemp()
+    out_dir = join(root, "out")
+    escapes = ["../../../../evil.FLM", "/evil.FLM",
+               "Flash/../../../../evil.FLM"]
+    c = cmsis_pack_manager.Cache(True, True, data_path=data_path)
+    for num, name in enumerate(escapes):
+        device = write_pack(data_path, "vendor%d" % num,
+                            [("Flash/a.FLM", b"a"), (name, b"evil")])
+        with patch.object(c, "_device_entry", return_value=device):
+            try:
+                c.extract_flash_algorithms(["device"], out_dir)
+                assert False
+            except ValueError:
+                pass
+    c.close()
+    try:
+        cmsis_pack_manager._join_within(out_dir, "..", "pack", "1.0.0")
+        assert False
+    except ValueError:
+        pass
+    assert(not exists(out_dir))
+    assert(not exists(join(root, "evil.FLM")))
+    assert(not exists("/evil.FLM"))
+    rmtree(data_path)
+    rmtree(root)
+
+def test_flash_algorithms_from_old_index():
+    data_path = mkdtemp()
+    out_dir = mkdtemp()
+    device = write_pack(data_path, "vendor", [("Flash/a.FLM", b"a"),
+                                              ("Flash/b.FLM", b"b")])
+    for algo in device['algorithms']:
+        algo['file_name'] = algo['file_name'].replace("/", "\\")
+    c = cmsis_pack_manager.Cache(True, True, data_path=data_path)
+    with patch.object(c, "_device_entry", return_value=device):
+        assert(c.get_flash_algorithm_binary("device").read() == b"a")
+        assert([algo.read() for algo
+                in c.get_flash_algorithm_binary("device", all=True)] ==
+               [b"a", b"b"])
+        assert(c.open_flash_algorithm("device").read() == b"a")
+        c.extract_flash_algorithms(["device"], out_dir)
+    c.close()
+    with open(join(out_dir, "vendor", "pack", "1.0.0", "Flash", "b.FLM"),
+              "rb") as fd:
+        assert(fd.read() == b"b")
+    rmtree(data_path)
+    rmtree(out_dir)
+
+@given(integers(min_value=0,
+                max_value=3 * cmsis_pack_manager._COPY_BUFFER_SIZE))
+@settings(max_examples=20)
+def test_copy_file(size):
+    contents = urandom(size)
+    dst = BytesIO()
+    cmsis_pack_manager._copy_file(BytesIO(contents), dst)
+    assert(dst.getvalue() == contents)
+
+def test_open_and_write_flash_algorithm():
+    data_path = mkdtemp()
+    big = urandom(cmsis_pack_manager._COPY_BUFFER_SIZE * 5 // 2)
+    device = write_pack(data_path, "vendor", [("Flash/big.FLM", big),
+                                              ("Flash/small.FLM", b"small")])
+    dest = join(data_path, "big.FLM")
+    c = cmsis_pack_manager.Cache(True, True, data_path=data_path)
+    with patch.object(c, "_device_entry", return_value=device):
+        with c.open_flash_algorithm("device") as algo:
+            assert(algo.read(5) == big[:5])
+            assert(algo.read() == big[5:])
+        c.write_flash_algorithm("device", dest)
+    c.close()
+    with open(dest, "rb") as fd:
+        assert(fd.read() == big)
+    rmtree(data_path)
+
+@given(lists(text(alphabet=ascii_lowercase, min_size=1), unique=True),
+       lists(booleans(), min_size=4, max_size=4))
+def test_find_pdsc(names, upper):
+    ext = "".join(c.upper() if u else c for c, u in zip("pdsc", upper))
+    zf = MagicMock()
+    zf.namelist.return_value = names + ["pack." + ext]
+    assert(cmsis_pack_manager.Cache.find_pdsc(zf) == "pack." + ext)
+    zf.namelist.return_value = names
+    assert(cmsis_pack_manager.Cache.find_pdsc(zf) is None)
+
+
+@given(dictionaries(text(alphabet=ascii_letters, min_size=1),
+                    dictionaries(text(alphabet=ascii_letters),
+                                 text(alphabet=ascii_letters))),
+       dictionaries(text(alphabet=ascii_letters, min_size=1),
+                    text(alphabet=ascii_letters)))
+@settings(max_examples=20)
+def test_iter_devices_and_aliases(devices, aliases):
+    json_path = mkdtemp()
+    c = cmsis_pack_manager.Cache(True, True, json_path=json_path)
+    with open(c.index_path, "w") as fd:
+        dump(devices, fd)
+    with open(c.aliases_path, "w") as fd:
+        dump(aliases, fd)
+    assert(dict(c.iter_devices()) == c.index)
+    assert(dict(c.iter_aliases()) == c.aliases)
+    rmtree(json_path)
+
+
+@given(lists(text(alphabet="abcd", min_size=1), min_size=1, unique=True),
+       lists(text(alphabet="abcd", min_size=1), min_size=1),
+       booleans())
+@settings(max_examples=20)
+def test_dump_parts_selection(names, parts, intersection):
+    out = mkdtemp()
+    cache = MagicMock()
+    cache.iter_devices.side_effect = lambda: iter(
+        [(name, {}) for name in names])
+    oper = operator.and_ if intersection else operator.or_
+    with patch("cmsis_pack_manager.pack_manager.dump") as _dump:
+        pack_manager.command_dump_parts(cache, out, parts, intersection)
+    assert(set(_dump.call_args[0][0]) ==
+           pack_manager.fuzzy_find(parts, names, oper))
+    rmtree(out)
+